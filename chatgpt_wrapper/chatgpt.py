@@ -1,12 +1,12 @@
 import platform
 import asyncio
 import signal
-import base64
-import json
 import time
 import uuid
 import re
 import shutil
+import sys
+from json import JSONDecodeError
 from typing import Optional
 from playwright.async_api import async_playwright
 from playwright._impl._api_structures import ProxySettings
@@ -15,8 +15,111 @@ from chatgpt_wrapper.config import Config
 from chatgpt_wrapper.logger import Logger
 import chatgpt_wrapper.constants as constants
 
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    from json import loads
+
+# FICLONE below is a Linux ioctl number, other platforms always copy.
+if sys.platform.startswith("linux"):
+    import fcntl
+else:
+    fcntl = None
+
 is_windows = platform.system() == "Windows"
 
+# ioctl request to clone a file's extents copy-on-write, from linux/fs.h.
+FICLONE = 0x40049409
+
+def _reflink_or_copy(src, dst):
+    """Copy a file as a copy-on-write clone where the filesystem supports it
+    (btrfs, xfs), falling back to a regular copy otherwise."""
+    if fcntl is not None:
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            shutil.copystat(src, dst)
+            return dst
+        except OSError:
+            pass
+    return shutil.copy2(src, dst)
+
+SESSION_JSON_RE = re.compile('{.*}')
+
+# Scripts injected into the page. Values are passed in as page.evaluate()
+# arguments, so the sources are built once here instead of on every call.
+# Stream events are handed back through the chatgptChunk and chatgptEof
+# bindings exposed on the page, tagged with the stream id so Python can drop
+# events from earlier requests. Running requests are kept in
+# window.chatgptStreams so they can be interrupted by id.
+ASK_STREAM_JS = """
+([request, bearer_token, stream_id]) => {
+  const xhr = new XMLHttpRequest();
+  window.chatgptStreams = window.chatgptStreams || {};
+  window.chatgptStreams[stream_id] = xhr;
+  xhr.open('POST', 'https://chat.openai.com/backend-api/conversation');
+  xhr.setRequestHeader('Accept', 'text/event-stream');
+  xhr.setRequestHeader('Content-Type', 'application/json');
+  xhr.setRequestHeader('Authorization', 'Bearer ' + bearer_token);
+  xhr.responseType = 'stream';
+  xhr.onreadystatechange = function() {
+    var newEvent;
+    if(xhr.interrupted) {
+      return;
+    }
+    if(xhr.readyState == 3 || xhr.readyState == 4) {
+      // Scan the complete events received since the last call, each byte only
+      // once, and keep the newest one. Every event carries the full message
+      // so far, so the older ones can be skipped.
+      const responseText = xhr.responseText;
+      let start = xhr.seenBytes || 0;
+      let end;
+      while((end = responseText.indexOf('\\n\\n', start)) !== -1) {
+        const line = responseText.substring(start, end);
+        start = end + 2;
+        if(line.startsWith('data: ') && line !== 'data: [DONE]') {
+          newEvent = line.substring(6);
+        }
+      }
+      xhr.seenBytes = start;
+      if(newEvent !== undefined) {
+        try {
+          // using XHR for eventstream sucks and occasionally ive seen incomplete
+          // json objects come through  JSON.parse will throw if that happens, and
+          // that should just skip until we get a full response.
+          JSON.parse(newEvent);
+        } catch (err) {
+          console.log(err);
+          newEvent = undefined;
+        }
+      }
+      if(newEvent !== undefined) {
+        // JSON.parse succeeded above, so the raw event is valid JSON.
+        window.chatgptChunk(stream_id, newEvent);
+      }
+    }
+    if(xhr.readyState == 4) {
+      delete window.chatgptStreams[stream_id];
+      window.chatgptEof(stream_id);
+    }
+  };
+  xhr.send(JSON.stringify(request));
+}
+"""
+
+INTERRUPT_STREAM_JS = """
+(stream_id) => {
+  const xhr = (window.chatgptStreams || {})[stream_id];
+  if(xhr) {
+    console.warn('Interrupting stream');
+    delete window.chatgptStreams[stream_id];
+    xhr.interrupted = true;
+    xhr.abort();
+  }
+}
+"""
+
 class AsyncChatGPT:
     """
     A ChatGPT interface that uses Playwright to run a browser,
@@ -24,62 +127,122 @@ class AsyncChatGPT:
     order to provide an open API to ChatGPT.
     """
 
-    stream_div_id = "chatgpt-wrapper-conversation-stream-data"
-    eof_div_id = "chatgpt-wrapper-conversation-stream-data-eof"
-    interrupt_div_id = "chatgpt-wrapper-conversation-stream-data-interrupt"
     session_div_id = "chatgpt-wrapper-session-data"
 
+    # All instances share one Playwright instance and browser context, each
+    # instance gets its own page in it.
+    _shared_play = None
+    _shared_browser = None
+    _shared_user_data_dir = None
+    _shared_launch_settings = None
+    _shared_users = 0
+    # Created lazily so it is bound to the running event loop.
+    _shared_lock = None
+
 
     def __init__(self, config=None):
         self.config = config or Config()
         self.log = Logger(self.__class__.__name__, self.config)
         self.play = None
-        self.user_data_dir = None
         self.page = None
         self.browser = None
         self.parent_message_id = str(uuid.uuid4())
         self.conversation_id = None
         self.conversation_title_set = None
         self.model = self.config.get('chat.model')
+        if self.model not in constants.RENDER_MODELS:
+            raise ValueError(f"Invalid model '{self.model}', must be one of: {', '.join(constants.RENDER_MODELS)}")
+        self.render_model = constants.RENDER_MODELS[self.model]
         self.session = None
+        self.auth_header = {}
         self.streaming = None
+        self.stream_id = None
+        self.stream_queue = None
+        self._registered = False
 
     async def create(self, timeout=60, proxy: Optional[ProxySettings] = None):
         self.streaming = False
         self._setup_signal_handlers()
         self.lock = asyncio.Lock()
-        self.play = await async_playwright().start()
         browser = self.config.get('browser.provider')
         headless = not self.config.get('browser.debug')
-        try:
-            playbrowser = getattr(self.play, browser)
-        except Exception:
-            print(f"Browser {browser} is invalid, falling back on firefox")
-            playbrowser = self.play.firefox
-        try:
-            self.browser = await playbrowser.launch_persistent_context(
-                user_data_dir="/tmp/playwright",
-                headless=headless,
-                proxy=proxy,
-            )
-        except Exception:
-            self.user_data_dir = f"/tmp/{str(uuid.uuid4())}"
-            shutil.copytree("/tmp/playwright", self.user_data_dir)
-            self.browser = await playbrowser.launch_persistent_context(
-                user_data_dir=self.user_data_dir,
-                headless=headless,
-                proxy=proxy,
-            )
-
-        if len(self.browser.pages) > 0:
+        async with self._get_shared_lock():
+            self.browser = await self._get_or_launch_browser(browser, headless, proxy)
+            self._check_launch_settings(browser, headless, proxy)
+            first_user = AsyncChatGPT._shared_users == 0
+            AsyncChatGPT._shared_users += 1
+            self._registered = True
+        self.play = AsyncChatGPT._shared_play
+
+        # The first instance takes over the page the context was opened with.
+        if first_user and len(self.browser.pages) > 0:
             self.page = self.browser.pages[0]
         else:
             self.page = await self.browser.new_page()
+        await self.page.expose_binding("chatgptChunk", self._on_stream_chunk)
+        await self.page.expose_binding("chatgptEof", self._on_stream_eof)
         await self._start_browser()
         self.timeout = timeout
         self.log.info("ChatGPT initialized")
         return self
 
+    @staticmethod
+    def _get_shared_lock():
+        if AsyncChatGPT._shared_lock is None:
+            AsyncChatGPT._shared_lock = asyncio.Lock()
+        return AsyncChatGPT._shared_lock
+
+    @staticmethod
+    async def _get_or_launch_browser(browser, headless, proxy):
+        """Return the shared browser context, launching it on first use.
+
+        Must be called with the shared lock held.
+        """
+        if AsyncChatGPT._shared_browser is not None:
+            return AsyncChatGPT._shared_browser
+        play = await async_playwright().start()
+        try:
+            playbrowser = getattr(play, browser)
+        except Exception:
+            print(f"Browser {browser} is invalid, falling back on firefox")
+            playbrowser = play.firefox
+        user_data_dir = None
+        try:
+            try:
+                context = await playbrowser.launch_persistent_context(
+                    user_data_dir="/tmp/playwright",
+                    headless=headless,
+                    proxy=proxy,
+                )
+            except Exception:
+                user_data_dir = f"/tmp/{uuid.uuid4().hex}"
+                shutil.copytree("/tmp/playwright", user_data_dir, copy_function=_reflink_or_copy)
+                context = await playbrowser.launch_persistent_context(
+                    user_data_dir=user_data_dir,
+                    headless=headless,
+                    proxy=proxy,
+                )
+        except Exception:
+            await play.stop()
+            raise
+        AsyncChatGPT._shared_play = play
+        AsyncChatGPT._shared_browser = context
+        AsyncChatGPT._shared_user_data_dir = user_data_dir
+        AsyncChatGPT._shared_launch_settings = (browser, headless, proxy)
+        return context
+
+    def _check_launch_settings(self, browser, headless, proxy):
+        # The settings of the instance that launched the shared context apply
+        # to all instances. A different proxy would silently route traffic
+        # elsewhere, so refuse it, other differences only warrant a warning.
+        shared_browser, shared_headless, shared_proxy = AsyncChatGPT._shared_launch_settings
+        if proxy != shared_proxy:
+            raise ValueError(f"Proxy {proxy} differs from the proxy {shared_proxy} of the shared browser already running")
+        if browser != shared_browser:
+            self.log.warning(f"Browser {browser} requested, but the shared {shared_browser} browser is already running, using it")
+        if headless != shared_headless:
+            self.log.warning(f"Headless mode {headless} requested, but the shared browser is already running with headless mode {shared_headless}, using it")
+
     def _setup_signal_handlers(self):
         sig = is_windows and signal.SIGBREAK or signal.SIGUSR1
         signal.signal(sig, self.terminate_stream)
@@ -93,11 +256,28 @@ class AsyncChatGPT:
 
     async def cleanup(self):
         self.log.info("Cleaning up")
-        await self.browser.close()
-        # remove the user data dir in case this is a second instance
-        if self.user_data_dir:
-            shutil.rmtree(self.user_data_dir)
-        await self.play.stop()
+        # nothing to release if create() never got a share of the browser
+        if not self._registered:
+            return
+        try:
+            if self.page is not None:
+                await self.page.close()
+        finally:
+            self._registered = False
+            AsyncChatGPT._shared_users -= 1
+        async with self._get_shared_lock():
+            if AsyncChatGPT._shared_users > 0 or AsyncChatGPT._shared_browser is None:
+                return
+            # last instance using the shared browser, shut it down
+            await AsyncChatGPT._shared_browser.close()
+            # remove the user data dir in case another process held the default one
+            if AsyncChatGPT._shared_user_data_dir:
+                shutil.rmtree(AsyncChatGPT._shared_user_data_dir)
+            await AsyncChatGPT._shared_play.stop()
+            AsyncChatGPT._shared_play = None
+            AsyncChatGPT._shared_browser = None
+            AsyncChatGPT._shared_user_data_dir = None
+            AsyncChatGPT._shared_launch_settings = None
 
     async def refresh_session(self, timeout=15):
         """Refresh session, by redirecting the *page* to /api/auth/session rather than a simple xhr request.
@@ -108,6 +288,8 @@ class AsyncChatGPT:
             timeout (int, optional): Timeout waiting for the refresh in seconds. Defaults to 10.
         """
         self.log.info("Refreshing session...")
+        # One deadline covers both waiting for the page and the browser check.
+        deadline = time.monotonic() + timeout
         await self.page.goto("https://chat.openai.com/api/auth/session")
         try:
             await self.page.wait_for_url("/api/auth/session", timeout=timeout * 1000)
@@ -115,8 +297,21 @@ class AsyncChatGPT:
             self.log.error("Timed out refreshing session. Page is now at %s. Calling _start_browser()...")
             await self._start_browser()
         try:
+            # Back off while the browser check runs, but give up once the
+            # deadline has passed instead of waiting forever.
+            delay = 1
             while "Please stand by, while we are checking your browser..." in await self.page.content():
-                await asyncio.sleep(1)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.log.error("Timed out waiting for the browser check to complete")
+                    # leave an unusable session rather than None, callers
+                    # check it for an accessToken
+                    self.session = {}
+                    self.auth_header = {}
+                    await self._start_browser()
+                    return
+                await asyncio.sleep(min(delay, remaining))
+                delay = min(delay * 2, 4)
             contents = await self.page.content()
             """
             By GETting /api/auth/session, the server would ultimately return a raw json file.
@@ -127,46 +322,47 @@ class AsyncChatGPT:
 
             The following code tries to extract the json part from the page, by simply finding the first `{` and the last `}`.
             """
-            found_json = re.search('{.*}', contents)
+            found_json = SESSION_JSON_RE.search(contents)
             if found_json is None:
-                raise json.JSONDecodeError("Cannot find JSON in /api/auth/session 's response", contents, 0)
+                raise JSONDecodeError("Cannot find JSON in /api/auth/session 's response", contents, 0)
             contents = contents[found_json.start():found_json.end()]
             self.log.debug("Refreshing session received: %s", contents)
-            self.session = json.loads(contents)
+            self.session = loads(contents)
+            if "accessToken" in self.session:
+                self.auth_header = {"Authorization": f"Bearer {self.session['accessToken']}"}
+            else:
+                self.auth_header = {}
             self.log.info("Succeessfully refreshed session. ")
-        except json.JSONDecodeError:
+        except JSONDecodeError:
             self.log.error("Failed to decode session key. Maybe Access denied? ")
 
         # Now the browser should be at /api/auth/session
         # Go back to the chat page.
         await self._start_browser()
 
-    async def _cleanup_divs(self):
-        await self.page.evaluate(f"document.getElementById('{self.stream_div_id}').remove()")
-        code = (
-            """
-            const eof_div = document.getElementById('EOF_DIV_ID');
-            if(typeof eof_div !== 'undefined' && eof_div !== null) {
-              eof_div.remove();
-            }
-            """
-        ).replace("EOF_DIV_ID", self.eof_div_id)
-        await self.page.evaluate(code)
+    def _on_stream_chunk(self, _source, stream_id, payload):
+        if stream_id == self.stream_id:
+            self.stream_queue.put_nowait(payload)
+
+    def _on_stream_eof(self, _source, stream_id):
+        if stream_id == self.stream_id:
+            self.stream_queue.put_nowait(None)
 
     def _api_request_build_headers(self, custom_headers={}):
-        headers = {
-            "Authorization": f"Bearer {self.session['accessToken']}",
-        }
-        headers.update(custom_headers)
-        return headers
+        # The auth header only changes on refresh_session(), so it is built
+        # there and shared by all requests. The returned dict may be that
+        # shared one and must not be modified.
+        if not self.auth_header:
+            raise KeyError("accessToken")
+        return {**self.auth_header, **custom_headers} if custom_headers else self.auth_header
 
     async def _process_api_response(self, url, response, method="GET"):
         self.log.debug(f"{method} {url} response, OK: {response.ok}, TEXT: {await response.text()}")
         json = None
         if response.ok:
             try:
-                json = await response.json()
-            except json.JSONDecodeError:
+                json = loads(await response.body())
+            except JSONDecodeError:
                 pass
         if not response.ok or not json:
             self.log.debug(f"{response.status} {response.status_text} {response.headers}")
@@ -193,7 +389,7 @@ class AsyncChatGPT:
         url = f"https://chat.openai.com/backend-api/conversation/gen_title/{self.conversation_id}"
         data = {
             "message_id": self.parent_message_id,
-            "model": constants.RENDER_MODELS[self.model],
+            "model": self.render_model,
         }
         ok, json, response = await self._api_post_request(url, data)
         if ok:
@@ -297,95 +493,59 @@ class AsyncChatGPT:
                     "content": {"content_type": "text", "parts": [prompt]},
                 }
             ],
-            "model": constants.RENDER_MODELS[self.model],
+            "model": self.render_model,
             "conversation_id": self.conversation_id,
             "parent_message_id": self.parent_message_id,
             "action": "next",
         }
 
-        code = (
-            """
-            const stream_div = document.createElement('DIV');
-            stream_div.id = "STREAM_DIV_ID";
-            document.body.appendChild(stream_div);
-            const xhr = new XMLHttpRequest();
-            xhr.open('POST', 'https://chat.openai.com/backend-api/conversation');
-            xhr.setRequestHeader('Accept', 'text/event-stream');
-            xhr.setRequestHeader('Content-Type', 'application/json');
-            xhr.setRequestHeader('Authorization', 'Bearer BEARER_TOKEN');
-            xhr.responseType = 'stream';
-            xhr.onreadystatechange = function() {
-              var newEvent;
-              const interrupt_div = document.getElementById('INTERRUPT_DIV_ID');
-              if(xhr.readyState == 3 || xhr.readyState == 4) {
-                const newData = xhr.response.substr(xhr.seenBytes);
-                try {
-                  const newEvents = newData.split(/\\n\\n/).reverse();
-                  newEvents.shift();
-                  if(newEvents[0] == "data: [DONE]") {
-                    newEvents.shift();
-                  }
-                  if(newEvents.length > 0) {
-                    newEvent = newEvents[0].substring(6);
-                    // using XHR for eventstream sucks and occasionally ive seen incomplete
-                    // json objects come through  JSON.parse will throw if that happens, and
-                    // that should just skip until we get a full response.
-                    JSON.parse(newEvent);
-                  }
-                } catch (err) {
-                  console.log(err);
-                  newEvent = undefined;
-                }
-                if(newEvent !== undefined) {
-                  stream_div.innerHTML = btoa(newEvent);
-                  xhr.seenBytes = xhr.responseText.length;
-                }
-              }
-              if(xhr.readyState == 4 && (typeof interrupt_div === 'undefined' || interrupt_div === null)) {
-                const eof_div = document.createElement('DIV');
-                eof_div.id = "EOF_DIV_ID";
-                document.body.appendChild(eof_div);
-              }
-              if(typeof interrupt_div !== 'undefined' && interrupt_div !== null) {
-                console.warn('Interrupting stream');
-                xhr.abort();
-                interrupt_div.remove();
-              }
-            };
-            xhr.send(JSON.stringify(REQUEST_JSON));
-            """.replace(
-                "BEARER_TOKEN", self.session["accessToken"]
-            )
-            .replace("REQUEST_JSON", json.dumps(request))
-            .replace("STREAM_DIV_ID", self.stream_div_id)
-            .replace("EOF_DIV_ID", self.eof_div_id)
-            .replace("INTERRUPT_DIV_ID", self.interrupt_div_id)
-        )
-
         self.streaming = True
-        await self.page.evaluate(code)
+        # Events for this stream id are pushed onto this queue by the page
+        # bindings, with None marking the end of the stream.
+        self.stream_id = uuid.uuid4().hex
+        self.stream_queue = asyncio.Queue()
+        # The request and ids are handed over as evaluate arguments, so
+        # Playwright serializes them once instead of splicing them into the
+        # script source.
+        await self.page.evaluate(ASK_STREAM_JS, [
+            request,
+            self.session["accessToken"],
+            self.stream_id,
+        ])
 
         last_event_msg = ""
-        start_time = time.time()
+        received = False
+        deadline = time.monotonic() + self.timeout
         while True:
             if not self.streaming:
                 self.log.info("Request to interrupt streaming")
                 await self.interrupt_stream()
                 break
-            eof_datas = await self.page.query_selector_all(f"div#{self.eof_div_id}")
 
-            conversation_datas = await self.page.query_selector_all(
-                f"div#{self.stream_div_id}"
-            )
-            if len(conversation_datas) == 0:
+            # The short timeout lets us notice interrupts and the overall
+            # timeout while waiting.
+            try:
+                payloads = [await asyncio.wait_for(self.stream_queue.get(), timeout=0.2)]
+            except asyncio.TimeoutError:
+                if not received and time.monotonic() > deadline:
+                    self.log.warning("Timed out waiting for a response")
+                    await self.interrupt_stream()
+                    break
                 continue
+            received = True
+            # Every event carries the full message so far, so only the newest
+            # one queued needs to be decoded.
+            while not self.stream_queue.empty():
+                payloads.append(self.stream_queue.get_nowait())
+            eof = payloads[-1] is None
+            if eof:
+                payloads.pop()
 
             full_event_message = None
 
             try:
-                event_raw = base64.b64decode(await conversation_datas[0].inner_html())
-                if len(event_raw) > 0:
-                    event = json.loads(event_raw)
+                if payloads:
+                    event = loads(payloads[-1])
                     if event is not None:
                         self.parent_message_id = event["message"]["id"]
                         self.conversation_id = event["conversation_id"]
@@ -408,29 +568,22 @@ class AsyncChatGPT:
 
             # if we saw the eof signal, this was the last event we
             # should process and we are done
-            if len(eof_datas) > 0 or (((time.time() - start_time) > self.timeout) and full_event_message is None):
+            if eof:
                 break
 
-            await asyncio.sleep(0.2)
-
         if not self.streaming:
             yield (
                 "\nGeneration stopped\n"
             )
         self.streaming = False
-        await self._cleanup_divs()
+        self.stream_id = None
+        self.stream_queue = None
         await self._gen_title()
 
     async def interrupt_stream(self):
         self.log.info("Interrupting stream")
-        code = (
-            """
-            const interrupt_div = document.createElement('DIV');
-            interrupt_div.id = "INTERRUPT_DIV_ID";
-            document.body.appendChild(interrupt_div);
-            """
-        ).replace("INTERRUPT_DIV_ID", self.interrupt_div_id)
-        await self.page.evaluate(code)
+        if self.stream_id is not None:
+            await self.page.evaluate(INTERRUPT_STREAM_JS, self.stream_id)
 
     def terminate_stream(self, _signal, _frame):
         self.log.info("Received signal to terminate stream")
@@ -533,7 +533,7 @@ class GPTShell():
             return
 
         if self.stream:
-            response = ""
+            chunks = []
             first = True
             async for chunk in self.backend.ask_stream(line):
                 if first:
@@ -541,8 +541,9 @@ class GPTShell():
                     first = False
                 print(chunk, end="")
                 sys.stdout.flush()
-                response += chunk
+                chunks.append(chunk)
             print("\n")
+            response = "".join(chunks)
         else:
             response = await self.backend.ask(line)
             print("")
@@ -17,6 +17,9 @@ setup(
     url="https://github.com/mmabrouk/chatgpt-wrapper",
     packages=find_packages(),
     install_requires=install_requirement,
+    extras_require={
+        "fast": ["orjson"],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",